@@ -1,9 +1,21 @@
+import asyncio
+import ctypes
 import socket
 import struct
-import threading
 import time
 import os
 from ansi_colors import *
+import mmsg
+
+try:
+    import uvloop  # Optional, faster drop-in event loop
+except ImportError:
+    uvloop = None
+
+try:
+    import numpy  # Optional, validates received UDP headers a whole batch at a time
+except ImportError:
+    numpy = None
 
 # Constants for the packet formats and magic cookie
 MAGIC_COOKIE = 0xabcddcba
@@ -11,9 +23,37 @@ OFFER_TYPE = 0x2
 REQUEST_TYPE = 0x3
 PAYLOAD_TYPE = 0x4
 
+# Precompiled packet formats
+OFFER_MESSAGE = struct.Struct('!IBHH')
+REQUEST_MESSAGE = struct.Struct('!IBQ')
+PAYLOAD_HEADER = struct.Struct('!IBQQ')
+
+if numpy:
+    # Payload headers of a mmsg.RecvBatch buffer, one record per datagram slot
+    BATCH_HEADER_DTYPE = numpy.dtype({
+        'names': ['magic_cookie', 'message_type', 'segment_count'],
+        'formats': ['>u4', 'u1', '>u8'],
+        'offsets': [0, 4, 5],
+        'itemsize': mmsg.DATAGRAM_SIZE,
+    })
+    # Lengths of the datagrams, read from the batch's mmsghdr array
+    BATCH_LENGTH_DTYPE = numpy.dtype({
+        'names': ['msg_len'],
+        'formats': [numpy.uintc],
+        'offsets': [mmsg.MMsgHdr.msg_len.offset],
+        'itemsize': ctypes.sizeof(mmsg.MMsgHdr),
+    })
+
 # Configurable ports using environment variables
 SERVER_UDP_PORT = int(os.getenv('SERVER_UDP_PORT', 15000))
 
+# Upper bound on the transfers (and open sockets) running at the same time
+MAX_CONCURRENT_TRANSFERS = max(1, int(os.getenv('MAX_CONCURRENT_TRANSFERS', 64))) # At least one, or no transfer would ever start
+
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024 # 4 MiB kernel receive queue for the client sockets
+TCP_SEND_BUFFER_SIZE = 2 * 1024 * 1024 # 2 MiB kernel send buffer for the TCP tests
+TCP_CHUNK_SIZE = 65536 # Bytes read per recv in the TCP tests
+
 def listen_for_offers():
     """
     Listens for UDP offers from the server.
@@ -28,16 +68,23 @@ def listen_for_offers():
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # ReUse of running port 
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
     udp_socket.bind(('', SERVER_UDP_PORT))
     udp_socket.settimeout(35)  # Prevent infinite loop
 
+    buffer = bytearray(2048)  # Reused for every received datagram
+
     try:
 
         while True:
 
             try:
-                data, server_address = udp_socket.recvfrom(2048)
-                magic_cookie, message_type, server_udp_port, server_tcp_port = struct.unpack('!IBHH', data)
+                nbytes, server_address = udp_socket.recvfrom_into(buffer)
+                if nbytes != OFFER_MESSAGE.size:
+                    print(f"{ERROR_COLOR}Invalid offer received.{RESET_COLOR}")
+                    continue
+
+                magic_cookie, message_type, server_udp_port, server_tcp_port = OFFER_MESSAGE.unpack_from(buffer, 0)
 
                 if magic_cookie == MAGIC_COOKIE and message_type == OFFER_TYPE:
                     print(f"{SUCCESS_COLOR}Received offer from {server_address[0]} on UDP port: {server_udp_port}, and TCP port: {server_tcp_port}{RESET_COLOR}")
@@ -56,6 +103,22 @@ def listen_for_offers():
     finally:
         udp_socket.close()
 
+def read_positive_int(prompt):
+    """
+    Prompts the user for a single positive integer.
+
+    Args:
+        prompt (str): The text shown to the user
+
+    Returns:
+        int: The entered value, or None if it isn't a positive integer.
+    """
+    try:
+        value = int(input(prompt).strip())
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
 def get_user_input():
     """
     Collects and validates user input for file size and number of connections.
@@ -67,25 +130,22 @@ def get_user_input():
     """
     try:
         # File size input
-        file_size = input(f"{INFO_COLOR}Enter file size (bytes): {RESET_COLOR}").strip()
-        if not file_size.isdigit() or int(file_size) <= 0:
+        file_size = read_positive_int(f"{INFO_COLOR}Enter file size (bytes): {RESET_COLOR}")
+        if file_size is None:
             print(f"{ERROR_COLOR}Invalid file size. Must be a positive integer.{RESET_COLOR}")
             return None
-        file_size = int(file_size)
 
         # TCP connections input
-        tcp_connections = input(f"{INFO_COLOR}Enter number of TCP connections: {RESET_COLOR}").strip()
-        if not tcp_connections.isdigit() or int(tcp_connections) <= 0:
+        tcp_connections = read_positive_int(f"{INFO_COLOR}Enter number of TCP connections: {RESET_COLOR}")
+        if tcp_connections is None:
             print(f"{ERROR_COLOR}Invalid number for TCP connections. Must be a positive integer.{RESET_COLOR}")
             return None
-        tcp_connections = int(tcp_connections)
 
         # UDP connections input
-        udp_connections = input(f"{INFO_COLOR}Enter number of UDP connections: {RESET_COLOR}").strip()
-        if not udp_connections.isdigit() or int(udp_connections) <= 0:
+        udp_connections = read_positive_int(f"{INFO_COLOR}Enter number of UDP connections: {RESET_COLOR}")
+        if udp_connections is None:
             print(f"{ERROR_COLOR}Invalid number for UDP connections. Must be a positive integer.{RESET_COLOR}")
             return None
-        udp_connections = int(udp_connections)
 
         # Return validated inputs
         return file_size, tcp_connections, udp_connections
@@ -94,7 +154,7 @@ def get_user_input():
         print(f"{ERROR_COLOR}Error while collecting input: {e}{RESET_COLOR}")
         return None
 
-def initiate_tcp_test(server_ip, tcp_port, file_size, tcp_connections, transfer_id):
+async def initiate_tcp_test(server_ip, tcp_port, file_size, tcp_connections, transfer_id):
     """
     Initiates a single TCP speed test.
     - Connects to the server using TCP and sends a request for a specific file size.
@@ -107,25 +167,32 @@ def initiate_tcp_test(server_ip, tcp_port, file_size, tcp_connections, transfer_
         tcp_connections (int): Number of TCP connections
         transfer_id (int): ID of the transfer for logging purposes
     """
+    loop = asyncio.get_running_loop()
+
     try:
         tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tcp_socket.connect((server_ip, tcp_port))
+        tcp_socket.setblocking(False)  # Driven by the event loop
+        tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send the request without Nagle's delay
+        # Set before connecting so the advertised window scale matches the buffer
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_SEND_BUFFER_SIZE)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        await loop.sock_connect(tcp_socket, (server_ip, tcp_port))
 
         segment_size = file_size // tcp_connections
 
-        start_time = time.time()
-        tcp_socket.sendall(f"{segment_size}\n".encode())
+        start_time = time.monotonic()
+        await loop.sock_sendall(tcp_socket, f"{segment_size}\n".encode())
 
         bytes_receive = 0
-        chunk_size = 1024
+        buffer = memoryview(bytearray(TCP_CHUNK_SIZE))  # Reused for every read
 
         while bytes_receive < segment_size:
-            c = tcp_socket.recv(chunk_size)
-            if not c:
+            n = await loop.sock_recv_into(tcp_socket, buffer)
+            if not n:
                 break
-            bytes_receive += len(c)
+            bytes_receive += n
         
-        end_time = time.time()
+        end_time = time.monotonic()
         print(f"{SUCCESS_COLOR}TCP transfer #{transfer_id} finished, total time: {end_time - start_time:.2f} seconds, total speed: {segment_size * 8 / (end_time - start_time):.2f} bits/second{RESET_COLOR}")
 
     except Exception as e:
@@ -134,7 +201,24 @@ def initiate_tcp_test(server_ip, tcp_port, file_size, tcp_connections, transfer_
     finally:
         tcp_socket.close()
 
-def initiate_udp_test(server_ip, udp_port, file_size, udp_connections, transfer_id):
+def last_segment_count(header_records, length_records):
+    """
+    Validates the payload headers of a received batch with vectorized comparisons.
+
+    Args:
+        header_records (numpy.ndarray): The batch's headers (`BATCH_HEADER_DTYPE`)
+        length_records (numpy.ndarray): The batch's datagram lengths (`BATCH_LENGTH_DTYPE`)
+
+    Returns:
+        int: The segment count of the last valid header, or 0 if no header is valid.
+    """
+    valid = ((length_records['msg_len'] >= PAYLOAD_HEADER.size)
+             & (header_records['magic_cookie'] == MAGIC_COOKIE)
+             & (header_records['message_type'] == PAYLOAD_TYPE))
+    valid_counts = header_records['segment_count'][valid]
+    return int(valid_counts[-1]) if len(valid_counts) else 0
+
+async def initiate_udp_test(server_ip, udp_port, file_size, udp_connections, transfer_id):
     """
     Initiates a single UDP speed test.
     This function sends a speed test request to the server and measures the 
@@ -151,43 +235,75 @@ def initiate_udp_test(server_ip, udp_port, file_size, udp_connections, transfer_
         udp_connections (int): The number of concurrent UDP connections (used for splitting data).
         transfer_id (int): An identifier for this specific transfer (for logging).
     """
+    loop = asyncio.get_running_loop()
+    readable = None  # Set only while a reader callback is registered for the socket
+
     try:
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.settimeout(1) # The UDP transfer concludes after no data has been received for 1 second
+        udp_socket.setblocking(False)  # Driven by the event loop
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)  # Absorb bursts between drains
+        udp_socket.connect((server_ip, udp_port))  # Only accept packets from the server
 
         segment_size = file_size // udp_connections
-        request_segment = struct.pack('!IBQ', MAGIC_COOKIE, REQUEST_TYPE, segment_size)
+        request_segment = REQUEST_MESSAGE.pack(MAGIC_COOKIE, REQUEST_TYPE, segment_size)
+
+        try:
+            event = asyncio.Event()
+            loop.add_reader(udp_socket, event.set)
+            readable = event
+        except NotImplementedError:
+            pass  # e.g. Windows' ProactorEventLoop, the socket is awaited directly instead
 
-        start_time = time.time()
-        udp_socket.sendto(request_segment, (server_ip, udp_port))
+        start_time = time.monotonic()
+        udp_socket.send(request_segment)
 
         received_segments = 0
         total_segment_count = 0
-        last_received_time = time.time()  # the last time a packet recived
-        
-        while True:
-            try:
-                data, _ = udp_socket.recvfrom(2048)
-                last_received_time = time.time()  # update the last time a packet recived
-                received_segments += 1
+        batch = mmsg.RecvBatch()
+        unpack_header, views, length = PAYLOAD_HEADER.unpack_from, batch.views, batch.length
+        if numpy:
+            header_records = numpy.frombuffer(batch.buffer, dtype=BATCH_HEADER_DTYPE)
+            length_records = numpy.frombuffer(batch.msgs, dtype=BATCH_LENGTH_DTYPE)
 
-                if len(data) < 21: continue
-
-                magic_cookie, message_type, total_segment_count, _ = struct.unpack('!IBQQ', data[:21])
+        while not total_segment_count or received_segments < total_segment_count:
+            try:
+                count = batch.receive(udp_socket)  # Up to 64 packets per syscall
 
-                if magic_cookie != MAGIC_COOKIE or message_type != PAYLOAD_TYPE:
-                    continue
+            except BlockingIOError:
+                try:
+                    # The UDP transfer concludes after no data has been received for 1 second
+                    if readable is not None:
+                        readable.clear()
+                        await asyncio.wait_for(readable.wait(), 1)
+                        continue
 
-                if received_segments == total_segment_count:
-                    break
+                    # Without reader callbacks, the next datagram is received by the event loop itself
+                    batch.msgs[0].msg_len = await asyncio.wait_for(loop.sock_recv_into(udp_socket, views[0]), 1)
+                    count = 1
 
-            except socket.timeout as e:
-                if time.time() - last_received_time > 1:
+                except asyncio.TimeoutError:
                     print(f"{WARNING_COLOR}No packets received for 1 second. Ending UDP transfer.{RESET_COLOR}")
                     break
-                time.sleep(0.01) # waiting to avoid busy-waiting
 
-        end_time = time.time()
+            received_segments += count
+
+            if numpy:
+                total_segment_count = last_segment_count(header_records[:count], length_records[:count]) or total_segment_count
+
+            else:
+                for i in range(count):
+                    if length(i) < PAYLOAD_HEADER.size: continue
+
+                    magic_cookie, message_type, segment_count, _ = unpack_header(views[i], 0)
+
+                    if magic_cookie != MAGIC_COOKIE or message_type != PAYLOAD_TYPE:
+                        continue
+
+                    total_segment_count = segment_count
+
+            await asyncio.sleep(0)  # Let the other transfers run between batches
+
+        end_time = time.monotonic()
         success_rate = (received_segments / total_segment_count) * 100 if total_segment_count != 0 else 0
         print(f"{SUCCESS_COLOR}UDP transfer #{transfer_id} finished, total time: {end_time - start_time:.2f} seconds, total speed: {segment_size * 8 / (end_time - start_time):.2f} bits/second, percentage of packets received successfully: {success_rate:.2f}%{RESET_COLOR}")
 
@@ -195,12 +311,25 @@ def initiate_udp_test(server_ip, udp_port, file_size, udp_connections, transfer_
         print(f"{WARNING_COLOR}Error during UDP speed test: {e}{RESET_COLOR}")
     
     finally:
+        if readable is not None:
+            loop.remove_reader(udp_socket)
         udp_socket.close()
 
-def initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_connections, udp_connections):
+async def run_limited(limiter, transfer):
+    """
+    Runs a single transfer once a slot of the concurrency limiter is free.
+
+    Args:
+        limiter (asyncio.Semaphore): Limits the number of concurrent transfers
+        transfer (coroutine): The TCP or UDP test to run
+    """
+    async with limiter:
+        await transfer
+
+async def initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_connections, udp_connections):
     """
-    Initiates multiple TCP and UDP tests concurrently using threads.
-    - Starts the specified number of TCP and UDP connections.
+    Initiates multiple TCP and UDP tests concurrently on a single event loop.
+    - Starts the specified number of TCP and UDP connections, at most `MAX_CONCURRENT_TRANSFERS` at a time.
     - Waits for all transfers to complete before finishing.
 
     Args:
@@ -211,21 +340,12 @@ def initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_connection
         tcp_connections (int): Number of TCP connections
         udp_connections (int): Number of UDP connections
     """
-    tcp_threads = []
-    udp_threads = []
-
-    for i in range(tcp_connections):
-        tcp_thread = threading.Thread(target=initiate_tcp_test, args=(server_ip, tcp_port, file_size, tcp_connections, i+1))
-        tcp_threads.append(tcp_thread)
-        tcp_thread.start()
-
-    for i in range(udp_connections):
-        udp_thread = threading.Thread(target=initiate_udp_test, args=(server_ip, udp_port, file_size, udp_connections, i+1))
-        udp_threads.append(udp_thread)
-        udp_thread.start()
+    limiter = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
 
-    for thread in tcp_threads + udp_threads:
-        thread.join()
+    await asyncio.gather(
+        *[run_limited(limiter, initiate_tcp_test(server_ip, tcp_port, file_size, tcp_connections, i+1)) for i in range(tcp_connections)],
+        *[run_limited(limiter, initiate_udp_test(server_ip, udp_port, file_size, udp_connections, i+1)) for i in range(udp_connections)],
+    )
 
     print(f"{SUCCESS_COLOR}All transfers completed successfully.{RESET_COLOR}")
 
@@ -247,7 +367,9 @@ def main():
         file_size, tcp_connections, udp_connections = params
         print(f"{HIGHLIGHT_COLOR}Starting speed test with File Size: {file_size}, TCP Connections: {tcp_connections}, UDP Connections: {udp_connections}{RESET_COLOR}")
 
-        initiate_speed_test(server_ip_address, server_tcp_port, server_udp_port, file_size, tcp_connections, udp_connections)
+        if uvloop:
+            uvloop.install()
+        asyncio.run(initiate_speed_test(server_ip_address, server_tcp_port, server_udp_port, file_size, tcp_connections, udp_connections))
     
     else: 
         exit(1)
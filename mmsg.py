@@ -0,0 +1,213 @@
+"""mmsg.py - Batched datagram I/O through Linux recvmmsg(2)/sendmmsg(2), with portable fallbacks"""
+
+import ctypes
+import os
+import socket
+import sys
+
+BATCH_SIZE = 64        # Datagrams handled per syscall
+DATAGRAM_SIZE = 2048   # Receive buffer size of a single datagram
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0) # The sockets are non-blocking anyway
+
+# Mirrors of the structures in <sys/socket.h> and <sys/uio.h>
+class IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
+class SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16),  # Network byte order
+        ('sin_addr', ctypes.c_ubyte * 4),
+        ('sin_zero', ctypes.c_ubyte * 8),
+    ]
+
+# recvmmsg/sendmmsg are Linux only, every other platform falls back to one syscall per datagram
+recvmmsg, sendmmsg = None, None
+if sys.platform.startswith('linux'):
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        recvmmsg = libc.recvmmsg
+        recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        recvmmsg.restype = ctypes.c_int
+        sendmmsg = libc.sendmmsg
+        sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+        sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        recvmmsg, sendmmsg = None, None
+
+# Whether SendBatch.send works here (otherwise only `datagram` can be used)
+send_supported = sendmmsg is not None or hasattr(socket.socket, 'sendmsg')
+
+
+def raise_errno():
+    """
+    Raises the OSError matching the errno left by the last failed libc call
+    (e.g. BlockingIOError for EAGAIN).
+    """
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+
+
+class RecvBatch:
+    """
+    Preallocated buffers for draining up to `batch_size` datagrams with a single syscall.
+    - All datagrams are received into one contiguous buffer, `datagram_size` bytes apart.
+    - After `receive`, datagram i is `views[i]` and its length is `length(i)`
+      (also `msgs[i].msg_len`, for reading all lengths at once).
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, datagram_size=DATAGRAM_SIZE):
+        self.batch_size = batch_size
+        self.datagram_size = datagram_size
+        self.buffer = bytearray(batch_size * datagram_size)
+        buffer_view = memoryview(self.buffer)
+        self.views = [buffer_view[i * datagram_size:(i + 1) * datagram_size] for i in range(batch_size)]
+
+        # Point every message header at its own slot of the shared buffer
+        self._c_buffer = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        base_address = ctypes.addressof(self._c_buffer)
+        self._iovecs = (IOVec * batch_size)()
+        self.msgs = (MMsgHdr * batch_size)()
+        for i in range(batch_size):
+            self._iovecs[i].iov_base = base_address + i * datagram_size
+            self._iovecs[i].iov_len = datagram_size
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self, sock):
+        """
+        Receives the datagrams queued on a socket without blocking.
+
+        Args:
+            sock (socket): The UDP socket to read from.
+
+        Returns:
+            int: Number of datagrams received (at least 1).
+
+        Raises:
+            BlockingIOError: If no datagram is queued.
+        """
+        if recvmmsg is None:
+            self.msgs[0].msg_len = sock.recv_into(self.views[0], self.datagram_size, MSG_DONTWAIT)
+            return 1
+
+        count = recvmmsg(sock.fileno(), self.msgs, self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            raise_errno()
+        return count
+
+    def length(self, i):
+        """
+        Returns the length of the i-th datagram of the last `receive`.
+        """
+        return self.msgs[i].msg_len
+
+
+class SendBatch:
+    """
+    Preallocated messages for sending up to `batch_size` datagrams to one IPv4 address with a single syscall.
+    - Datagram i is `header_views[i]` followed by its payload (the shared one unless replaced).
+    - Headers are written in place into `headers`, `header_size` bytes apart.
+    - `reset` re-targets the batch, so it can be reused across transfers.
+    """
+
+    def __init__(self, address, header_size, payload, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.header_size = header_size
+        self.headers = bytearray(batch_size * header_size)
+        headers_view = memoryview(self.headers)
+        self.header_views = [headers_view[i * header_size:(i + 1) * header_size] for i in range(batch_size)]
+        self.payloads = [None] * batch_size
+
+        # Every message gathers two iovecs: its header slot and its payload
+        self._c_headers = (ctypes.c_char * len(self.headers)).from_buffer(self.headers)
+        headers_address = ctypes.addressof(self._c_headers)
+        self._address = SockAddrIn(socket.AF_INET)
+        self._iovecs = (IOVec * (2 * batch_size))()
+        self._msgs = (MMsgHdr * batch_size)()
+        for i in range(batch_size):
+            self._iovecs[2 * i].iov_base = headers_address + i * header_size
+            self._iovecs[2 * i].iov_len = header_size
+            self._msgs[i].msg_hdr.msg_name = ctypes.addressof(self._address)
+            self._msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(self._address)
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[2 * i])
+            self._msgs[i].msg_hdr.msg_iovlen = 2
+
+        self.reset(address, payload)
+
+    def reset(self, address, payload):
+        """
+        Points every datagram of the batch at a new destination and payload.
+
+        Args:
+            address (tuple): The (ip, port) the datagrams are sent to.
+            payload (bytes): The payload shared by all the datagrams.
+        """
+        self.address = address
+        self._address.sin_port = socket.htons(address[1])
+        self._address.sin_addr[:] = socket.inet_aton(address[0])
+        for i in range(self.batch_size):
+            self.set_payload(i, payload)
+
+    def set_payload(self, i, payload):
+        """
+        Replaces the payload of the i-th datagram.
+
+        Args:
+            i (int): Index of the datagram in the batch.
+            payload (bytes): The new payload, referenced rather than copied.
+        """
+        self.payloads[i] = payload
+        self._iovecs[2 * i + 1].iov_base = ctypes.cast(ctypes.c_char_p(payload), ctypes.c_void_p).value
+        self._iovecs[2 * i + 1].iov_len = len(payload)
+
+    def datagram(self, i):
+        """
+        Returns the i-th datagram as a single bytes object (for the non-batched send paths).
+        """
+        return bytes(self.header_views[i]) + self.payloads[i]
+
+    def send(self, sock, count):
+        """
+        Sends the first `count` datagrams of the batch without blocking (requires `send_supported`).
+        - A single sendmmsg syscall on Linux, one scatter-gather sendmsg per datagram elsewhere.
+
+        Args:
+            sock (socket): The UDP socket to send from.
+            count (int): Number of datagrams to send.
+
+        Returns:
+            int: Number of datagrams queued by the kernel (at least 1).
+
+        Raises:
+            BlockingIOError: If the socket's send buffer is full.
+        """
+        if sendmmsg is None:
+            for i in range(count):
+                try:
+                    sock.sendmsg([self.header_views[i], self.payloads[i]], [], MSG_DONTWAIT, self.address)
+                except BlockingIOError:
+                    if i:
+                        return i
+                    raise
+            return count
+
+        sent = sendmmsg(sock.fileno(), self._msgs, count, MSG_DONTWAIT)
+        if sent < 0:
+            raise_errno()
+        return sent
@@ -1,9 +1,30 @@
+import asyncio
+import logging
 import socket
-import struct
+import sys
+import tempfile
 import threading
-import time
+import struct
 import os
 from ansi_colors import *
+import mmsg
+
+try:
+    import uvloop  # Optional, faster drop-in event loop
+except ImportError:
+    uvloop = None
+
+try:
+    import psutil  # Optional, enables one offer broadcast per network interface
+except ImportError:
+    psutil = None
+
+# Per-connection messages are logged at DEBUG, so they cost nothing unless LOGLEVEL=DEBUG
+log = logging.getLogger(__name__)
+try:
+    log.setLevel(os.getenv('LOGLEVEL', 'INFO').upper())
+except ValueError:
+    log.setLevel(logging.INFO)  # Unknown level name
 
 # HotSpot IP:
 ServerIP= '172.20.10.10' # Adi HotSpot
@@ -19,6 +40,45 @@ PAYLOAD_TYPE = 0x4
 SERVER_UDP_PORT = int(os.getenv('SERVER_UDP_PORT', 15000))
 SERVER_TCP_PORT = int(os.getenv('SERVER_TCP_PORT', 16000))
 
+# Limited broadcast address, resolved once instead of '<broadcast>' on every send
+BROADCAST_ADDR = ('255.255.255.255', SERVER_UDP_PORT)
+
+UDP_BUFFER_SIZE = 4 * 1024 * 1024 # 4 MiB kernel send/receive buffers of the UDP socket
+TCP_BUFFER_SIZE = 2 * 1024 * 1024 # 2 MiB kernel send/receive buffers of the TCP connections
+
+# TCP listening sockets sharing the port with SO_REUSEPORT, each served by its own event loop thread.
+# Opt-in: SO_REUSEPORT would also let a second server start on the same port and split the clients with this one.
+TCP_LISTENERS = max(1, int(os.getenv('TCP_LISTENERS', 1))) if hasattr(socket, 'SO_REUSEPORT') else 1
+
+# Dummy payloads, allocated once and sliced for every chunk sent
+TCP_CHUNK_SIZE = 1024 * 1024 # Large writes let each send() fill the whole socket buffer
+TCP_PAYLOAD = memoryview(b'a' * TCP_CHUNK_SIZE)
+UDP_CHUNK_SIZE = 1024
+UDP_PAYLOAD = b'd' * UDP_CHUNK_SIZE
+
+# Size of the payload file sent with zero-copy sendfile(2). Every loop.sendfile call first waits for the
+# transport to flush, so each one covers up to 16 MiB.
+TCP_SENDFILE_SIZE = 16 * 1024 * 1024
+
+# Precompiled packet formats
+OFFER_MESSAGE = struct.Struct('!IBHH')
+REQUEST_MESSAGE = struct.Struct('!IBQ')
+PAYLOAD_HEADER = struct.Struct('!IBQQ')
+
+# The offer never changes, so it is packed once at import
+OFFER_PACKET = OFFER_MESSAGE.pack(MAGIC_COOKIE, OFFER_TYPE, SERVER_UDP_PORT, SERVER_TCP_PORT)
+OFFER_INTERVAL = 1 # Seconds between offer broadcasts
+
+class ColorFormatter(logging.Formatter):
+    """
+    Colors every log message by its level, so the messages themselves are only formatted once emitted.
+    """
+    LEVEL_COLORS = {logging.DEBUG: SUCCESS_COLOR, logging.INFO: INFO_COLOR, logging.WARNING: WARNING_COLOR}
+
+    def format(self, record):
+        return f"{self.LEVEL_COLORS.get(record.levelno, ERROR_COLOR)}{super().format(record)}{RESET_COLOR}"
+
+
 def get_local_ip():
     """
     Returns the current IP address of the server.
@@ -35,176 +95,370 @@ def get_local_ip():
     return ip_address
 
 
-def udp_offer_sender(udp_socket):
+def gil_enabled():
+    """
+    Returns whether the interpreter runs with the GIL (always True before Python 3.13).
+    """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled() if is_gil_enabled else True
+
+
+def get_broadcast_addresses():
     """
-    Continuously sends UDP offer messages to broadcast address every second.
+    Returns the addresses the offers are broadcast to.
+    - With psutil installed, the broadcast address of every IPv4 network interface.
+    - Otherwise (or if no interface reports one), only the limited broadcast address.
+    """
+    if psutil:
+        broadcasts = {address.broadcast for addresses in psutil.net_if_addrs().values()
+                      for address in addresses if address.family == socket.AF_INET and address.broadcast}
+        if broadcasts:
+            return [(broadcast, SERVER_UDP_PORT) for broadcast in sorted(broadcasts)]
+    return [BROADCAST_ADDR]
+
+
+async def udp_offer_sender(udp_transport):
+    """
+    Continuously sends UDP offer messages to the broadcast addresses every second.
       - Sends a packet containing the server's details for clients to detect availability.
-    No inputs, runs indefinitely unless an exception occurs.
+    Runs indefinitely unless an exception occurs, and stops right away when cancelled on shutdown.
+
+    Args:
+        udp_transport (asyncio.DatagramTransport): The transport of the server's UDP socket.
     """
     print(f"{INFO_COLOR}Starting UDP Offer Broadcast...{RESET_COLOR}")
     try:
-        offer_message = struct.pack('!IBHH', MAGIC_COOKIE, OFFER_TYPE, SERVER_UDP_PORT, SERVER_TCP_PORT)
-        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         while True:
-            udp_socket.sendto(offer_message, ('<broadcast>', SERVER_UDP_PORT))
+            # Looked up every time, so the offers follow interfaces that come up or change subnet (e.g. a hotspot)
+            for broadcast_address in get_broadcast_addresses():
+                udp_transport.sendto(OFFER_PACKET, broadcast_address)
             # print(f"{SUCCESS_COLOR}Offer broadcast sent!{RESET_COLOR}")
-            time.sleep(1)
+            await asyncio.sleep(OFFER_INTERVAL)
     except Exception as e:
         print(f"{ERROR_COLOR}Error in UDP offer sender: {e}{RESET_COLOR}")
 
 
-def handle_tcp_connection(client_socket):
+def create_payload_file():
+    """
+    Creates the file sent to the TCP clients: the TCP payload repeated up to `TCP_SENDFILE_SIZE` bytes,
+    in an anonymous in-memory file (a temporary file without memfd).
+
+    Returns:
+        file: The payload file, opened in binary mode.
+    """
+    payload_file = open(os.memfd_create('payload'), 'w+b') if hasattr(os, 'memfd_create') else tempfile.TemporaryFile()
+    for _ in range(TCP_SENDFILE_SIZE // TCP_CHUNK_SIZE):
+        payload_file.write(TCP_PAYLOAD)
+    payload_file.flush()
+    return payload_file
+
+
+async def handle_tcp_connection(reader, writer, payload_file):
     """
     Handles incoming TCP connections for speed testing.
     - Receives a file size request and sends the requested amount of dummy data.    
     
     Args:
-        client_socket (socket): The connected client socket for communication.
+        reader (asyncio.StreamReader): Stream for reading the client's request.
+        writer (asyncio.StreamWriter): Stream for sending data back to the client.
+        payload_file (file): The payload file from `create_payload_file`, sent with sendfile.
     """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("New TCP connection from %s", writer.get_extra_info('peername'))
     try:
-        data = client_socket.recv(1024).decode().strip()
+        # Buffer until the whole request line arrived, however the client's bytes were split
+        try:
+            request_line = await reader.readuntil(b'\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            log.error("Invalid TCP request received.")
+            return False
+
+        data = request_line.decode().strip()
 
         if not data or not data.isdigit() or int(data) <= 0:
-                print(f"{ERROR_COLOR}Invalid TCP request received.{RESET_COLOR}")
+                log.error("Invalid TCP request received.")
                 return False
 
         file_size_bytes = int(data)
-        print(f"{SUCCESS_COLOR}TCP Request received: {file_size_bytes} bytes{RESET_COLOR}")
+        log.debug("TCP Request received: %d bytes", file_size_bytes)
 
-        total_bytes_sent = 0
-        chunk_size = 1024
+        loop = asyncio.get_running_loop()
+        remaining_bytes = file_size_bytes
+        use_sendfile = True
         
-        while total_bytes_sent < file_size_bytes:
-            remaining_bytes = file_size_bytes - total_bytes_sent
-            chunk_to_send = b'a' * min(chunk_size, remaining_bytes)
-            client_socket.sendall(chunk_to_send)
-            total_bytes_sent += len(chunk_to_send)
-
-        print(f"{SUCCESS_COLOR}TCP transfer completed.{RESET_COLOR}")
+        while remaining_bytes:
+            if use_sendfile:
+                n = TCP_SENDFILE_SIZE if remaining_bytes >= TCP_SENDFILE_SIZE else remaining_bytes
+                try:
+                    await loop.sendfile(writer.transport, payload_file, 0, n, fallback=False)
+                    remaining_bytes -= n
+                    continue
+                except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                    use_sendfile = False  # e.g. an event loop or platform without native sendfile
+
+            n = TCP_CHUNK_SIZE if remaining_bytes >= TCP_CHUNK_SIZE else remaining_bytes
+            writer.write(TCP_PAYLOAD[:n])
+            await writer.drain()
+            remaining_bytes -= n
+
+        log.debug("TCP transfer completed.")
         return True
 
     except Exception as e:
-        print(f"{ERROR_COLOR}Error handling TCP connection: {e}{RESET_COLOR}")
+        log.error("Error handling TCP connection: %s", e)
         return False
 
     finally:
-        client_socket.close()
+        writer.close()
+
+def create_tcp_socket():
+    """
+    Creates a listening TCP socket on the server's TCP port.
+    - With SO_REUSEPORT, several of these sockets share the port and the kernel
+      load-balances the incoming connections between their accept queues.
 
-def start_tcp_server(tcp_socket):
+    Returns:
+        socket: The listening TCP socket.
+    """
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if TCP_LISTENERS > 1:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Inherited by the accepted connections (asyncio already sets TCP_NODELAY on them)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_BUFFER_SIZE)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_BUFFER_SIZE)
+    tcp_socket.bind(('0.0.0.0', SERVER_TCP_PORT))
+    tcp_socket.listen()
+    return tcp_socket
+
+
+async def start_tcp_server(tcp_socket, payload_file):
     """
     Starts the TCP server to handle incoming client connections for speed tests.
-    Binds the server to the configured TCP port and handles each connection in a new thread.
+    Serves the already bound listening socket and handles each connection in a new task.
 
     Args:
-        tcp_socket (socket): The connected client socket for communication.
+        tcp_socket (socket): The listening TCP socket of the server.
+        payload_file (file): The payload file sent to the clients.
     """
     try:
-        while True:
-            client_socket, client_address = tcp_socket.accept()
-            print(f"{INFO_COLOR}New TCP connection from {client_address}{RESET_COLOR}")
-            threading.Thread(target=handle_tcp_connection, args=(client_socket,)).start()
+        tcp_server = await asyncio.start_server(lambda reader, writer: handle_tcp_connection(reader, writer, payload_file), sock=tcp_socket)
+        async with tcp_server:
+            await tcp_server.serve_forever()
     except Exception as e:
         print(f"{ERROR_COLOR}Error in TCP server: {e}{RESET_COLOR}")
 
 
-def handle_udp_connection(data, client_address, udp_socket):
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol of the server's UDP socket.
+    - Each received request is handled in a separate task using the `handle_udp_connection` function.
+    - Tracks the transport's flow control so the senders wait while its write buffer is full.
+    - Keeps the send batches of finished transfers for reuse by the next ones.
+    """
+
+    def __init__(self, udp_socket):
+        self.transport = None
+        self.socket = udp_socket  # The transport only exposes a restricted wrapper of it
+        self.tasks = set()  # Strong references to the running handlers
+        self.free_batches = []  # Idle mmsg.SendBatch objects
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_address):
+        task = asyncio.create_task(handle_udp_connection(data, client_address, self))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def acquire_batch(self, client_address):
+        """
+        Returns a send batch targeting the client, reusing an idle one when possible.
+        """
+        if self.free_batches:
+            batch = self.free_batches.pop()
+            batch.reset(client_address, UDP_PAYLOAD)
+            return batch
+        return mmsg.SendBatch(client_address, PAYLOAD_HEADER.size, UDP_PAYLOAD)
+
+    def release_batch(self, batch):
+        """
+        Returns a send batch to the pool once its transfer is done.
+        """
+        self.free_batches.append(batch)
+
+    def error_received(self, exc):
+        log.error("Error in UDP server: %s", exc)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+
+async def send_udp_batch(udp_protocol, batch, count, client_address):
+    """
+    Sends the first `count` datagrams of a batch straight from the socket (sendmmsg or sendmsg).
+    - Datagrams the socket can't take right away are queued on the transport instead,
+      and the sender waits until the transport's write buffer drains.
+
+    Args:
+        - udp_protocol: The protocol of the socket used for communication
+        - batch (mmsg.SendBatch): The prepared datagrams
+        - count (int): Number of datagrams to send
+        - client_address: The address of the client
+    """
+    sent = 0
+    # Only bypass the transport while it has nothing queued
+    if mmsg.send_supported and not udp_protocol.transport.get_write_buffer_size():
+        try:
+            sent = batch.send(udp_protocol.socket, count)
+        except BlockingIOError:
+            pass
+
+    for i in range(sent, count):
+        udp_protocol.transport.sendto(batch.datagram(i), client_address)
+
+    # Let the other transfers run, and wait while the socket's send buffer is full
+    await asyncio.sleep(0)
+    await udp_protocol.can_write.wait()
+
+
+async def handle_udp_connection(data, client_address, udp_protocol):
     """
     Handles a single UDP speed test request by sending the requested file size back to the client.
 
     Args:
         - data: Received data packet containing request details
         - client_address: The address of the client sending the request
-        - udp_socket: The socket used for communication
+        - udp_protocol: The protocol of the socket used for communication
 
     Returns:
         - bool: True if the transfer was successful, False if an error occurred.
     """
     try:
-        if len(data) != 13:
+        if len(data) != REQUEST_MESSAGE.size:
             return False
 
-        unpacked_data = struct.unpack('!IBQ', data)
+        unpacked_data = REQUEST_MESSAGE.unpack(data)
         magic_cookie, message_type, file_size = unpacked_data
         if magic_cookie != MAGIC_COOKIE or message_type != REQUEST_TYPE:
-            print(f"{ERROR_COLOR}Invalid UDP request received, closing connection.{RESET_COLOR}")
+            log.error("Invalid UDP request received, closing connection.")
             return False
 
-        print(f"{SUCCESS_COLOR}UDP Request received for {file_size} bytes from {client_address}{RESET_COLOR}")
+        log.debug("UDP Request received for %d bytes from %s", file_size, client_address)
+
+        chunks = (file_size + UDP_CHUNK_SIZE - 1) // UDP_CHUNK_SIZE # split into chunks of 1024 bytes each
+        last_payload = UDP_PAYLOAD[:file_size - (chunks - 1) * UDP_CHUNK_SIZE] # only the final chunk may be short
 
-        chunk_size = 1024 # split into chunks of 1024 bytes each
-        chunks = (file_size + chunk_size - 1) // chunk_size
+        batch = udp_protocol.acquire_batch(client_address)
+        pack_header, headers = PAYLOAD_HEADER.pack_into, batch.headers
 
-        for chunk_number in range(chunks):
-            payload_header = struct.pack('!IBQQ', MAGIC_COOKIE, PAYLOAD_TYPE, chunks, chunk_number)
-            remaining_bytes = file_size - (chunk_number * chunk_size)
-            payload_message = b'd' * min(chunk_size, remaining_bytes)
-            udp_socket.sendto(payload_header + payload_message, client_address)
+        try:
+            for first_chunk in range(0, chunks, batch.batch_size):
+                count = min(batch.batch_size, chunks - first_chunk)
+                for i in range(count):
+                    pack_header(headers, i * PAYLOAD_HEADER.size, MAGIC_COOKIE, PAYLOAD_TYPE, chunks, first_chunk + i)
+                if first_chunk + count == chunks:
+                    batch.set_payload(count - 1, last_payload)
 
-        print(f"{SUCCESS_COLOR}UDP transfer completed.{RESET_COLOR}")
+                await send_udp_batch(udp_protocol, batch, count, client_address)
+        finally:
+            udp_protocol.release_batch(batch)
+
+        log.debug("UDP transfer completed.")
         return True
 
     except Exception as e:
-        print(f"{ERROR_COLOR}Error handling UDP connection: {e}{RESET_COLOR}")
+        log.error("Error handling UDP connection: %s", e)
         return False
 
-def start_udp_server(udp_socket):
+async def start_udp_server(udp_socket):
     """
     Starts the UDP server and listens for incoming speed test requests.
-    - This function runs an infinite loop, waiting for incoming UDP packets from clients.
-    - Each incoming request is handled in a separate thread using the `handle_udp_connection` function.
-    - Each received request is handled in a separate thread.
+    - Wraps the bound UDP socket in a datagram endpoint driven by `UDPServerProtocol`.
+    - Each received request is handled in a separate task.
 
     Args:
         udp_socket (socket): The UDP socket used for receiving client requests.
+
+    Returns:
+        asyncio.DatagramTransport: The transport of the UDP socket.
+    """
+    loop = asyncio.get_running_loop()
+    udp_transport, _ = await loop.create_datagram_endpoint(lambda: UDPServerProtocol(udp_socket), sock=udp_socket)
+    return udp_transport
+
+
+async def serve(udp_socket, tcp_socket, payload_file):
+    """
+    Runs the UDP offer broadcast, the UDP server and the TCP server on a single event loop.
+
+    Args:
+        udp_socket (socket): The bound UDP socket of the server.
+        tcp_socket (socket): The listening TCP socket of the server.
+        payload_file (file): The payload file sent to the TCP clients.
     """
+    udp_transport = await start_udp_server(udp_socket)
     try:
-        while True:
-            data, client_address = udp_socket.recvfrom(2048)
-            threading.Thread(target=handle_udp_connection, args=(data, client_address, udp_socket), daemon=True).start()
-    except Exception as e:
-        print(f"{ERROR_COLOR}Error in UDP server: {e}{RESET_COLOR}")
+        await asyncio.gather(udp_offer_sender(udp_transport), start_tcp_server(tcp_socket, payload_file))
+    finally:
+        udp_transport.close()
 
 
 # Main function to start both servers
 def main():
     """
     Main entry point for the server application.
-    This function initializes both the TCP and UDP servers and starts them
-    on separate threads to handle incoming client requests concurrently.
+    This function initializes both the TCP and UDP servers and runs them
+    on event loops to handle incoming client requests concurrently.
 
     Steps Performed:
-    1. Initializes the UDP and TCP sockets.
+    1. Initializes the UDP socket, the `TCP_LISTENERS` TCP sockets and the TCP payload file.
     2. Binds the sockets to the specified ports and configures socket options.
-    3. Starts the UDP broadcast for service discovery (`udp_offer_sender`).
-    4. Starts the TCP and UDP servers for handling speed test requests (`start_tcp_server`, `start_udp_server`).
-    5. Keeps the server running indefinitely unless an exception occurs.
+    3. Starts an event loop thread for every TCP socket but the first (`start_tcp_server`).
+    4. Starts the UDP broadcast for service discovery (`udp_offer_sender`).
+    5. Starts the UDP server and the first TCP server on the main event loop (`start_udp_server`, `start_tcp_server`).
+    6. Keeps the server running indefinitely unless an exception occurs.
     """
-    udp_socket, tcp_socket = None, None
+    log_handler = logging.StreamHandler(sys.stdout)
+    log_handler.setFormatter(ColorFormatter('%(message)s'))
+    logging.basicConfig(handlers=[log_handler])
+    udp_socket, tcp_sockets, payload_file = None, [], None
 
     try:
 
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         udp_socket.bind(('0.0.0.0', SERVER_UDP_PORT))
-        # udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
-        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
         print(f"{SUCCESS_COLOR}UDP Server started on port {SERVER_UDP_PORT}{RESET_COLOR}")
 
-        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        tcp_socket.bind(('0.0.0.0', SERVER_TCP_PORT))
-        tcp_socket.listen()
-        print(f"{SUCCESS_COLOR}TCP Server started on port {SERVER_TCP_PORT}{RESET_COLOR}")
+        for _ in range(TCP_LISTENERS):
+            tcp_sockets.append(create_tcp_socket())
+        print(f"{SUCCESS_COLOR}TCP Server started on port {SERVER_TCP_PORT} with {TCP_LISTENERS} listener(s){RESET_COLOR}")
+
+        payload_file = create_payload_file()
 
         print(f"{HIGHLIGHT_COLOR}Server started, listening on IP address {get_local_ip()}{RESET_COLOR}")
 
-        # Starting all servers in separate threads
-        threading.Thread(target=udp_offer_sender, args=(udp_socket,), daemon=True).start()
-        threading.Thread(target=start_tcp_server, args=(tcp_socket,), daemon=True).start()
-        threading.Thread(target=start_udp_server, args=(udp_socket,), daemon=True).start()
+        if TCP_LISTENERS > 1 and gil_enabled():
+            print(f"{INFO_COLOR}Note: running with the GIL, only one TCP listener thread runs Python code at a time. Use a free-threaded Python build (e.g. python3.13t) to run them in parallel.{RESET_COLOR}")
 
-        while True:
-            time.sleep(1)
+        if uvloop:
+            uvloop.install()
+
+        # Every extra TCP listener accepts and serves its connections on its own event loop
+        for tcp_socket in tcp_sockets[1:]:
+            threading.Thread(target=asyncio.run, args=(start_tcp_server(tcp_socket, payload_file),), daemon=True).start()
+
+        # Running the UDP servers and the first TCP listener on the main event loop
+        asyncio.run(serve(udp_socket, tcp_sockets[0], payload_file))
 
     except Exception as e:
         print(f"{ERROR_COLOR}Critical error during server startup: {e}{RESET_COLOR}")
@@ -212,8 +466,10 @@ def main():
     finally:
         if udp_socket:
             udp_socket.close()
-        if tcp_socket:
+        for tcp_socket in tcp_sockets:
             tcp_socket.close()
+        if payload_file:
+            payload_file.close()
 
 
 if __name__ == "__main__":